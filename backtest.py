@@ -0,0 +1,150 @@
+import os, sys, time
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
+from utils import *
+import pandas as pd
+import torch.nn as nn
+from model import Model
+from streaming import StreamingForecaster
+from sweep import share, init_worker, _shared
+
+
+_bases = {}
+
+
+def basis(threshold, shape):
+    # memory-mapped from the basis cache, so the workers share its pages
+    if (threshold, shape) not in _bases:
+        _bases[threshold, shape] = build_basis(_shared['d'], shape, q = threshold, cache = 'cache/basis')
+    return _bases[threshold, shape]
+
+
+def shift_weights(weights, s):
+    """
+    Weights of a window moved s steps forward: column j takes over column
+    j + s, the s new timesteps start from the last column
+    """
+    s = min(s, weights.size(1))
+    return torch.cat((weights[:, s:], weights[:, -1:].expand(-1, s)), 1)
+
+
+def fit(model, optimizer, X, g, p, batch_size, epochs):
+    input, target, input_indices, _ = generate_data(X, p)
+    loss_fn = nn.MSELoss()
+    for epoch in range(1, epochs + 1):
+        train_losses = 0
+        loader = batches(target.size(0), batch_size)
+        for idx in loader:
+            pred, _ = model(input[idx], input_indices[idx], g)
+            optimizer.zero_grad()
+            loss = loss_fn(pred, target[idx])
+            loss.backward()
+            optimizer.step()
+            train_losses += loss.item()
+        print(f"Epoch: {epoch}, Train loss: {train_losses / len(loader):.5f}")
+    return model
+
+
+def run_origin(config, origin, prev, horizons, log_dir, train_size, p, batch_size, lr, epochs, warm_epochs):
+    """
+    Train on the train_size steps before origin, warm-started from the
+    weights of the previous origin prev = (origin, weights) if given, and
+    forecast max(horizons) steps recursively. Returns the MSE of each horizon
+    """
+    threshold, shape = config
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f'{threshold}_{shape}.log'), 'a') as log, redirect_stdout(log):
+        print(f'Origin {origin}')
+        X = _shared['X']
+        g = basis(threshold, shape)
+        window = X[:, origin - train_size: origin]
+
+        model = Model(X.shape[0], train_size, 1, n_basis=g.shape[1], time_slice=True)
+        if prev is not None:
+            with torch.no_grad():
+                model.weights.copy_(shift_weights(prev[1], origin - prev[0]))
+            epochs = warm_epochs
+        optimizer = make_optimizer(model.parameters(), 'adam', lr)
+        fit(model, optimizer, window, g, p, batch_size, epochs)
+
+        H = max(horizons)
+        preds = StreamingForecaster(model, optimizer, g, window, p, steps=0).predict(H)
+    errors = ((preds - X[:, origin: origin + H]) ** 2).mean(0)
+    mse = {h: errors[h - 1].item() for h in horizons}
+    return config, origin, mse, model.weights.detach(), time.perf_counter() - start
+
+
+def backtest(origins, horizons, configs, workers, threads, dataset='air', log_dir='output/backtest', **kwargs):
+    """
+    Rolling-origin backtest of every (threshold, shape) config. The origins of
+    a config run in order, each warm-started from the previous one, while
+    configs run in parallel on a process pool sharing the data and the
+    cached bases. Returns the MSE of every (config, origin, horizon) and its
+    mean over the origins per horizon
+    """
+    from main import load_data
+    os.makedirs(log_dir, exist_ok=True)
+
+    origins = sorted(origins)
+    X, d = load_data(dataset)
+    if origins[0] < kwargs['train_size'] or origins[-1] + max(horizons) > X.shape[1]:
+        raise ValueError(f"Origins must lie in [{kwargs['train_size']}, {X.shape[1] - max(horizons)}]!")
+    for threshold, shape in configs:
+        build_basis(d, shape, q = threshold, cache = 'cache/basis')
+
+    shm_X, X_spec = share(X.numpy())
+    shm_d, d_spec = share(np.asarray(d))
+
+    rows = []
+    try:
+        with ProcessPoolExecutor(workers, mp_context=get_context('spawn'), initializer=init_worker,
+                                 initargs=(X_spec, d_spec, threads)) as pool:
+            def submit(config, i, prev):
+                return pool.submit(run_origin, config, origins[i], prev, horizons, log_dir, **kwargs)
+
+            pending = {submit(config, 0, None): (config, 0) for config in configs}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for job in done:
+                    config, i = pending.pop(job)
+                    _, origin, mse, weights, seconds = job.result()
+                    print(f'{config} origin {origin}: {seconds:.1f} seconds')
+                    rows += [{'threshold': config[0], 'shape': config[1], 'origin': origin, 'horizon': h,
+                              'mse': v, 'seconds': seconds} for h, v in mse.items()]
+                    if i + 1 < len(origins):
+                        pending[submit(config, i + 1, (origin, weights))] = (config, i + 1)
+    finally:
+        for shm in (shm_X, shm_d):
+            shm.close()
+            shm.unlink()
+
+    table = pd.DataFrame(rows).astype({'threshold': 'Int64'}) # None stays a threshold
+    table = table.sort_values(['threshold', 'shape', 'origin', 'horizon'], na_position='first')
+    summary = table.pivot_table(index=['threshold', 'shape'], columns='horizon', values='mse', dropna=False)
+    table.to_csv(os.path.join(log_dir, 'backtest.csv'), index=False)
+    summary.to_csv(os.path.join(log_dir, 'summary.csv'))
+    return table, summary
+
+
+if __name__ == "__main__":
+
+    # python backtest.py [--workers W] [--threads K] [--origins 200,230] [--horizons 1,7] [--shapes convex_dec] [thresholds ...]
+    workers = int(pop_option('--workers', os.cpu_count()))
+    threads = int(pop_option('--threads', 1))
+    origins = [int(o) for o in pop_option('--origins', '200,230,260,290,320').split(',')]
+    horizons = [int(h) for h in pop_option('--horizons', '1,7,14,30').split(',')]
+    shapes = pop_option('--shapes', 'convex_dec').split(',')
+    thresholds = [None if t == 'None' else int(t) for t in sys.argv[1:]] or [10, 50, 100]
+
+    train_size = 200
+    p = 1
+    batch_size = 50
+    lr = 0.01
+    epochs = 100
+    warm_epochs = 20 # epochs of the origins warm-started from the previous one
+
+    configs = [(t, s) for s in shapes for t in thresholds]
+    table, summary = backtest(origins, horizons, configs, workers, threads, train_size=train_size, p=p,
+                              batch_size=batch_size, lr=lr, epochs=epochs, warm_epochs=warm_epochs)
+    print(summary.to_string())
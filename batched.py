@@ -0,0 +1,327 @@
+import os, re, sys
+from utils import *
+import pandas as pd
+import torch.nn as nn
+
+
+class BatchedModel(nn.Module):
+    """
+    R independent STVAR models stacked along a leading replicate dimension,
+    weights : [R, n_basis, T]. Replicate r has the state of model.Model(N, T)
+    (T = 1 for stationary.Model) and they share one basis g
+    """
+    def __init__(self, R, N, T, gain=1.0, n_basis=None, time_slice=False):
+        super(BatchedModel, self).__init__()
+
+        self.R = R
+        self.N = N
+        self.T = T
+        self.time_slice = time_slice
+
+        n_basis = N * N if n_basis is None else n_basis
+        w = torch.empty(R, n_basis, T)
+        for r in range(R):
+            nn.init.xavier_normal_(w[r], gain=gain)
+        self.weights = nn.Parameter(w)
+
+    def shape_function(self, g, t=None):
+        """
+        F = g @ weights[r][:, t] ** 2 for every replicate -> [R, N ** 2, u]
+        """
+        W = self.weights if t is None else self.weights[:, :, t]
+        R, n, u = W.shape
+        # one basis product for all replicates
+        W = (W ** 2).transpose(0, 1).reshape(n, R * u)
+        F = basis_matmul(g, W)
+        return F.reshape(-1, R, u).transpose(0, 1)
+
+    def forward(self, x, x_i, g):
+        """
+        x : [R, b, N, p]
+        x_i : [b, p], shared by the replicates
+        """
+        if self.time_slice:
+            t, x_i = torch.unique(x_i, return_inverse=True)
+            F = self.shape_function(g, t) # [R, N ** 2, u]
+        else:
+            F = self.shape_function(g) # [R, N ** 2, T]
+
+        w = F.transpose(1, 2).reshape(self.R, -1, self.N, self.N) # [R, T, N, N]
+        w = torch.softmax(w, -1)
+        w_ = w[:, x_i] # [R, b, p, N, N]
+        x_ = x.transpose(2, 3).unsqueeze(-1) # [R, b, p, N, 1]
+
+        Z = torch.matmul(w_, x_)
+        Z = Z.sum((2, -1)) # [R, b, N]
+        return Z, F
+
+
+def replicate_checkpoint(model, optimizer, r, step=None):
+    """
+    Checkpoint of replicate r in the format of a single model trained with Adam.
+    step : [R] Adam steps of the replicates returned by train_batched, replicate r
+    lags the shared step of the optimizer by step.max() - step[r]
+    """
+    state = optimizer.state_dict()
+    state['state'] = {k: {name: v[r].clone() if torch.is_tensor(v) and v.dim() > 0 else v.clone()
+                          for name, v in s.items()} for k, s in state['state'].items()}
+    if step is not None:
+        for s in state['state'].values():
+            s['step'] -= step.max() - step[r]
+    return {'model_state_dict': {'weights': model.weights[r].detach().clone()},
+            'optimizer_state_dict': state, 'optimizer': type(optimizer).__name__}
+
+
+def replicate_adam_step(model, optimizer, step):
+    """
+    optimizer.step() of Adam with the bias correction of every replicate r at
+    its own step[r], i.e. the update of a separate model restored from
+    replicate_checkpoint. step : [R] is advanced in place
+    """
+    group = optimizer.param_groups[0]
+    beta1, beta2 = group['betas']
+    lr, eps = group['lr'], group['eps']
+    param = model.weights
+    state = optimizer.state[param]
+    with torch.no_grad():
+        grad = param.grad
+        if group['weight_decay'] != 0:
+            grad = grad.add(param, alpha=group['weight_decay'])
+        state['exp_avg'].lerp_(grad, 1 - beta1)
+        state['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        step += 1
+        # same arithmetic as torch's single tensor Adam, with python float corrections
+        for r, s in enumerate(step.tolist()):
+            bias_correction2_sqrt = (1 - beta2 ** s) ** 0.5
+            denom = (state['exp_avg_sq'][r].sqrt() / bias_correction2_sqrt).add_(eps)
+            param[r].addcdiv_(state['exp_avg'][r], denom, value=-lr / (1 - beta1 ** s))
+        # the shared step stays the largest one, the lag of replicate_checkpoint
+        state['step'] = step.max().clone()
+
+
+def replicate_mse(pred, y):
+    # per-replicate mean squared error [R]
+    return ((pred - y) ** 2).mean(tuple(range(1, pred.dim())))
+
+
+def train_batched(X, g, p, batch_size, epochs, lr, stationary=False, V=0, verbose=True, targets=None):
+    """
+    Fit R replicates X : [R, N, T] at once. Their summed losses give each
+    replicate the gradient of its own loss, and Adam updates elementwise, so
+    replicate r follows its own training run. The last V windows are held out
+    for validation as in stationary.train. targets : [R, T - p, N] replaces the
+    targets of the windows of X, e.g. by bootstrap samples.
+    Returns the model and its optimizer, restored per replicate to its best
+    epoch, and the Adam step [R] of every replicate. The optimizer keeps
+    their maximum as its single step
+    """
+    R, N, T = X.shape
+
+    input, target, input_indices, _ = generate_data(X, p)
+    if targets is not None:
+        target = targets
+    if stationary:
+        input_indices = torch.zeros_like(input_indices)
+
+    model = BatchedModel(R, N, 1 if stationary else T, 1, n_basis=g.shape[1], time_slice=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    tloss = torch.full((R,), 1e+10)
+    vloss = torch.full((R,), 1e+10)
+    best = checkpoint_state(model, optimizer)
+
+    for epoch in range(1, epochs + 1):
+        train_losses = torch.zeros(R)
+        loader = batches(T-p-V, batch_size)
+        for idx in progress(loader, verbose):
+            pred, _ = model(input[:, idx], input_indices[idx], g)
+            optimizer.zero_grad()
+            loss = replicate_mse(pred, target[:, idx])
+            loss.sum().backward()
+            optimizer.step()
+            train_losses += loss.detach()
+
+        train_loss = train_losses / len(loader)
+        improved = train_loss < tloss
+        msg = f"Epoch: {epoch}, Train loss: {train_loss.mean():.5f}"
+        if V > 0:
+            with torch.no_grad():
+                pred, _ = model(input[:, -V:], input_indices[-V:], g)
+                val_loss = replicate_mse(pred, target[:, -V:])
+            improved &= val_loss <= vloss
+            vloss = torch.where(improved, val_loss, vloss)
+            msg += f", Val loss: {val_loss.mean():.5f}"
+        print(msg + f", Improved: {int(improved.sum())}/{R}")
+        tloss = torch.where(improved, train_loss, tloss)
+
+        # keep the best state of every replicate
+        state = checkpoint_state(model, optimizer)
+        for bs, s in ((best['model_state_dict'], state['model_state_dict']),
+                      (best['optimizer_state_dict']['state'].setdefault(0, {}), state['optimizer_state_dict']['state'][0])):
+            for k, v in s.items():
+                if k not in bs:
+                    bs[k] = v.clone()
+                if v.dim() > 0:
+                    bs[k][improved] = v[improved]
+                else:
+                    bs[k] = v.expand(R).clone() if bs[k].dim() == 0 else torch.where(improved, v, bs[k])
+
+    model.load_state_dict(best['model_state_dict'])
+    # Adam needs a scalar step
+    state = best['optimizer_state_dict']['state'][0]
+    step = state['step']
+    state['step'] = step.max()
+    optimizer.load_state_dict(best['optimizer_state_dict'])
+    return model, optimizer, step
+
+
+def forecast_batched(X, g, p, model, optimizer, train_size, until, epochs, h, step=None):
+    """
+    forecast.forecast for all replicates X : [R, N, T] at once
+    step : [R] Adam steps returned by train_batched, the updates then correct
+    the bias of every replicate at its own step, as forecast.forecast on its
+    replicate_checkpoint. step is advanced in place
+    Returns outputs [R, N, T] and shape functions [R, N ** 2, T]
+    """
+    R, N, T_ = X.shape
+    T = train_size
+    model.time_slice = False
+    loss_fn = replicate_mse
+
+    input, target, input_indices, _ = generate_data(X, p)
+
+    with torch.no_grad():
+        preds, F = model(input[:, :T-p], input_indices[:T-p], g)
+    preds = torch.cat((X[:, :, :p].transpose(1, 2), preds), dim=1) # [R, L, N]
+    Fs = [F]
+
+    while True:
+        with torch.no_grad():
+            print(f'Forecasting the next {h} steps ...')
+            x = input[:, T - p: T + h - p]
+            hx = x.size(1)
+            x_i = torch.arange(train_size-hx, train_size).unsqueeze(-1)
+            y_hat, _ = model(x, x_i, g)
+            preds = torch.cat((preds, y_hat), dim=1)
+            L = preds.size(1)
+            remaining = max(0, until + train_size - L)
+            print(f'{remaining} steps until completion')
+
+        if remaining == 0:
+            print('Finished !')
+            break
+
+        T = L
+        print('Updating model ...')
+        X_new = preds[:, -train_size:].transpose(1, 2)
+        x, y, x_i, _ = generate_data(X_new, p)
+        for i in range(epochs):
+            y_hat, F = model(x, x_i, g)
+            optimizer.zero_grad()
+            loss_fn(y_hat, y).sum().backward()
+            if step is None:
+                optimizer.step()
+            else:
+                replicate_adam_step(model, optimizer, step)
+        Fs.append(F[:, :, -hx:].detach())
+
+    out = preds.transpose(1, 2)[:, :, :T_]
+    print(loss_fn(out, X).tolist())
+    F = torch.cat(Fs, 2)[:, :, :T_]
+    return out, F
+
+
+def forecast_stationary(X, g, p, model):
+    """
+    stationary.forecast for all replicates X : [R, N, T] at once
+    """
+    input, target, input_indices, _ = generate_data(X, p)
+    with torch.no_grad():
+        pred, F = model(input, torch.zeros_like(input_indices), g)
+    print(replicate_mse(pred, target).tolist())
+    out = torch.cat((X[:, :, :p], pred.transpose(1, 2)), dim=-1)
+    return out, F
+
+
+def check(R=3, N=4, T=120, train_size=80, h=10):
+    """
+    Runs the batched pipeline on random data, with update blocks (h < until),
+    and checks every replicate against forecast_batched of a single replicate
+    restored from its checkpoint, stepped by torch's Adam
+    """
+    torch.manual_seed(0)
+    np.random.seed(0)
+    X = torch.randn(R, N, T)
+    d = np.random.rand(N * N)
+    g = build_basis(d, 'convex_dec', q = N)
+    # a large lr makes the replicates reach their best epoch at different steps
+    model, optimizer, step = train_batched(X[:, :, :train_size], g, 1, 20, 8, 1.0, verbose=False)
+    assert len(set(step.tolist())) > 1, step
+    checkpoints = [replicate_checkpoint(model, optimizer, r, step) for r in range(R)]
+    out, F = forecast_batched(X, g, 1, model, optimizer, train_size, T - train_size, 2, h, step)
+    assert out.shape == (R, N, T) and F.shape[0] == R
+
+    for r, checkpoint in enumerate(checkpoints):
+        single = BatchedModel(1, N, train_size, n_basis=g.shape[1])
+        single.load_state_dict({'weights': checkpoint['model_state_dict']['weights'][None]})
+        adam = torch.optim.Adam(single.parameters(), lr=1.0)
+        state = checkpoint['optimizer_state_dict']
+        state['state'] = {k: {name: v[None] if v.dim() > 0 else v for name, v in s.items()}
+                          for k, s in state['state'].items()}
+        adam.load_state_dict(state)
+        out_r, _ = forecast_batched(X[r:r+1], g, 1, single, adam, train_size, T - train_size, 2, h)
+        assert torch.allclose(out[r], out_r[0], atol=1e-5), (r, (out[r] - out_r[0]).abs().max())
+    print('OK')
+
+
+def load_replicates(data_dir):
+    # s{i}.csv files of a simulation, ordered by i
+    files = [f for f in os.listdir(data_dir) if re.fullmatch(r's\d+\.csv', f)]
+    ids = sorted(int(f[1:-4]) for f in files)
+    X = [pd.read_csv(os.path.join(data_dir, f's{i}.csv')).iloc[:, 1:].to_numpy() for i in ids]
+    return ids, np.stack(X)
+
+
+if __name__ == "__main__":
+
+    # python batched.py stationary|non_stationary data/stationary/csv output/stationary model/stationary threshold
+    # python batched.py check
+    sample_path = 'data/sample.pickle'
+    kind = sys.argv[1]
+    if kind == 'check':
+        check()
+        sys.exit()
+    data_dir, output_dir, model_dir = sys.argv[2:5]
+    threshold = None if sys.argv[5] == 'None' else int(sys.argv[5])
+
+    torch.set_num_threads(os.cpu_count())
+    ids, X = load_replicates(data_dir)
+    _, d = load_pickle(sample_path)
+    Xts = torch.from_numpy(X).float()
+
+    train_size = 300
+    epochs = 100
+    p = 1
+    shape = 'convex_dec'
+    g = build_basis(d, shape, q = threshold, cache = 'cache/basis')
+
+    if kind == 'stationary':
+        batch_size = 50
+        lr = 0.01
+        model, optimizer, step = train_batched(Xts[:, :, :train_size], g, p, batch_size, epochs, lr, stationary=True, V=50, verbose=False)
+        out, F = forecast_stationary(Xts, g, p, model)
+        Xs = X
+    elif kind == 'non_stationary':
+        batch_size = 300
+        lr = 0.001
+        model, optimizer, step = train_batched(Xts[:, :, :train_size], g, p, batch_size, epochs, lr, verbose=False)
+        until = 200
+        h = until
+        out, F = forecast_batched(Xts, g, p, model, optimizer, train_size, until, epochs, h, step)
+        Xs = Xts.numpy()
+    else:
+        raise ValueError('Unknown simulation!')
+
+    for r, i in enumerate(ids):
+        torch.save(replicate_checkpoint(model, optimizer, r, step), os.path.join(model_dir, f'model{i}.pt'))
+        write_pickle([Xs[r], out[r].detach().numpy(), F[r].detach().numpy()], os.path.join(output_dir, f'out{i}.pickle'))
@@ -0,0 +1,134 @@
+import os, sys, time
+from utils import *
+import torch.nn as nn
+from model import Model
+from torch.utils.data import DataLoader
+
+
+def random_distances(N, seed=0):
+    rng = np.random.default_rng(seed)
+    loc = rng.random((N, 2))
+    d = np.sqrt(((loc[:, None, :] - loc[None, :, :]) ** 2).sum(-1))
+    return d.reshape(-1)
+
+
+def basis_function_loop(d, shape, q = None):
+    # Reference column-by-column construction
+    m = d.shape[0]
+    if q is None:
+      sorted_d = np.sort(d)
+    else:
+      qr, idx = get_quantiles(d, q)
+      sorted_idx = np.sort(idx)
+      sorted_d = np.zeros_like(d)
+      sorted_d[sorted_idx] = qr
+
+    g = []
+    for i in range(m):
+        if shape == 'monotone_inc':
+            a = (d >= sorted_d[i]).astype('float')
+            b = int(sorted_d[i] <= 0.0)
+            g.append(a - b)
+        elif shape == 'concave_inc':
+            a = (d <= sorted_d[i]).astype('float')
+            gx = np.multiply(d-sorted_d[i], a) + sorted_d[i] * int(sorted_d[i] >= 0.0)
+            g.append(gx)
+        elif shape == 'monotone_dec':
+            a = (d <= sorted_d[i]).astype('float')
+            g.append(a)
+        elif shape == 'convex_dec':
+            a = (d <= sorted_d[i]).astype('float')
+            gx = np.multiply(sorted_d[i]-d, a)
+            g.append(gx)
+
+    g = np.stack(g, axis=1)
+    if q is not None:
+      g[idx, ] = 0
+    return g
+
+
+def get_quantiles_loop(d, q):
+    # Reference nearest-entry search, one argmin per quantile
+    r = np.arange(q) / q
+    qr = np.quantile(d, r)
+    idx = [(np.abs(d - i)).argmin() for i in qr]
+    return qr, idx
+
+
+def timeit(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def bench_basis(N, q=None):
+    d = random_distances(N)
+    for shape in shapes:
+        ref, t_loop = timeit(basis_function_loop, d, shape, q)
+        g, t_vec = timeit(basis_function, d, shape, q)
+        assert np.array_equal(ref, g)
+        print(f'{shape:>13} N={N} q={q}: loop {t_loop:.3f}s, blocked {t_vec:.3f}s, speed-up {t_loop / t_vec:.1f}x')
+
+
+def bench_quantiles(N, q):
+    d = random_distances(N)
+    (qr, idx), t_loop = timeit(get_quantiles_loop, d, q)
+    (qr_, idx_), t_vec = timeit(get_quantiles, d, q)
+    assert np.array_equal(qr, qr_) and np.array_equal(idx, idx_)
+    print(f'quantiles N={N} q={q}: argmin loop {t_loop:.4f}s, searchsorted {t_vec:.4f}s, speed-up {t_loop / t_vec:.1f}x')
+
+
+def bench_loader(N, T=300, batch_size=50, epochs=20):
+    d = random_distances(N)
+    g = build_basis(d, 'convex_dec')
+    X = torch.randn(N, T)
+    input, target, input_indices, _ = generate_data(X, 1)
+    loss_fn = nn.MSELoss()
+
+    def fit(loaders):
+        torch.manual_seed(0)
+        model = Model(N, T, 1, time_slice=True)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+        steps = 0
+        start = time.perf_counter()
+        for loader in loaders():
+            for idx in loader:
+                pred, _ = model(input[idx, ], input_indices[idx, ], g)
+                optimizer.zero_grad()
+                loss = loss_fn(pred, target[idx, ])
+                loss.backward()
+                optimizer.step()
+                steps += 1
+        return steps / (time.perf_counter() - start)
+
+    with open(os.devnull, 'w') as devnull:
+        def dataloader():
+            loader = DataLoader(list(range(T - 1)), batch_size=batch_size, shuffle=True)
+            for _ in range(epochs):
+                yield tqdm(loader, file=devnull)
+        before = fit(dataloader)
+
+    def tensor_batches():
+        for _ in range(epochs):
+            yield progress(batches(T - 1, batch_size), verbose=False)
+    after = fit(tensor_batches)
+    print(f'loader N={N} T={T} b={batch_size}: DataLoader + tqdm {before:.0f} steps/s, batches {after:.0f} steps/s, speed-up {after / before:.1f}x')
+
+
+if __name__ == "__main__":
+
+    # python benchmark.py basis N [q]
+    # python benchmark.py quantiles N q
+    # python benchmark.py loader N [T]
+    task = sys.argv[1]
+    N = int(sys.argv[2])
+    arg = None if len(sys.argv) < 4 or sys.argv[3] == 'None' else int(sys.argv[3])
+
+    if task == 'basis':
+        bench_basis(N, arg)
+    elif task == 'quantiles':
+        bench_quantiles(N, arg)
+    elif task == 'loader':
+        bench_loader(N) if arg is None else bench_loader(N, T=arg)
+    else:
+        raise ValueError('Unknown benchmark!')
@@ -0,0 +1,95 @@
+import os, shutil, hashlib, warnings
+import numpy as np
+import torch
+
+
+class BasisCache:
+    """
+    Content-addressed on-disk cache of basis matrices.
+    Each entry is a directory keyed by a hash of (d, shape, q, ...) holding
+    either a dense float32 `g.npy` or the CSR arrays of a sparse basis.
+    Entries are memory-mapped on load and evicted least recently used first
+    once the cache grows beyond max_bytes.
+    """
+    version = 1
+
+    def __init__(self, root='cache/basis', max_bytes=4 * 2 ** 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, d, *args):
+        h = hashlib.sha1(np.ascontiguousarray(d, dtype='float64').tobytes())
+        h.update(repr((self.version,) + args).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.root, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            g = self._load(path)
+        except (OSError, ValueError):
+            return None
+        os.utime(path) # mark as recently used
+        return g
+
+    def put(self, key, g):
+        path = os.path.join(self.root, key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        if g.layout == torch.strided:
+            np.save(os.path.join(tmp, 'g.npy'), g.numpy())
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # sparse CSR is in beta
+                g = g.to_sparse_csr()
+            np.save(os.path.join(tmp, 'crow_indices.npy'), g.crow_indices().numpy())
+            np.save(os.path.join(tmp, 'col_indices.npy'), g.col_indices().numpy())
+            np.save(os.path.join(tmp, 'values.npy'), g.values().numpy())
+            np.save(os.path.join(tmp, 'size.npy'), np.array(g.shape))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # written concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def _load(self, path):
+        # copy-on-write maps: torch shares the pages without a read-only warning
+        def load(name):
+            return torch.from_numpy(np.load(os.path.join(path, name), mmap_mode='c'))
+
+        if os.path.isfile(os.path.join(path, 'g.npy')):
+            return load('g.npy')
+        size = tuple(np.load(os.path.join(path, 'size.npy')))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # sparse CSR is in beta
+            return torch.sparse_csr_tensor(load('crow_indices.npy'), load('col_indices.npy'),
+                                           load('values.npy'), size=size)
+
+    def entries(self):
+        out = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(path))
+            out.append((os.stat(path).st_mtime, size, name))
+        return sorted(out)
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
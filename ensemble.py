@@ -0,0 +1,79 @@
+import os, sys
+from utils import *
+from batched import train_batched
+
+
+def bootstrap_targets(X, g, p, model, K):
+    """
+    K residual bootstrap samples [K, T - p, N] of the targets of X : [N, T],
+    the fitted values of model plus residual vectors of the windows drawn
+    with replacement. Returns the samples and the residuals [T - p, N]
+    """
+    input, target, input_indices, _ = generate_data(X, p)
+    with torch.no_grad():
+        fitted = model(input[None], input_indices, g)[0][0]
+    residuals = target - fitted
+    idx = torch.randint(len(residuals), (K, len(residuals)))
+    return fitted + residuals[idx], residuals
+
+
+def train_ensemble(X, g, p, K, batch_size, epochs, lr, verbose=True):
+    """
+    Fit a model to X : [N, T], then K members at once as a BatchedModel on
+    residual bootstrap samples of its targets, all sharing the inputs of X.
+    Returns the members and the residuals of the fitted model
+    """
+    print('Fitting the model ...')
+    model, _, _ = train_batched(X[None], g, p, batch_size, epochs, lr, verbose=verbose)
+    targets, residuals = bootstrap_targets(X, g, p, model, K)
+    print(f'Fitting {K} bootstrap members ...')
+    members, _, _ = train_batched(X.expand(K, -1, -1), g, p, batch_size, epochs, lr, verbose=verbose, targets=targets)
+    return members, residuals
+
+
+def forecast_quantiles(X, g, p, members, residuals, train_size, until, q=(0.05, 0.5, 0.95)):
+    """
+    Forecast the until steps after train_size from the observed inputs as
+    forecast.forecast without retraining, for all members in one forward.
+    A bootstrap residual is added to every member forecast, so the
+    quantiles q : [len(q), until, N] cover both parameter and noise uncertainty
+    """
+    K = members.R
+    input, _, _, _ = generate_data(X, p)
+    x = input[train_size - p: train_size + until - p]
+    hx = x.size(0)
+    # step k uses the weights of the last hx columns, as in forecast.forecast
+    x_i = (torch.arange(train_size - hx, train_size)[:, None] + torch.arange(1 - p, 1)).clamp(min=0)
+    with torch.no_grad():
+        y, _ = members(x.expand(K, *x.shape), x_i, g) # [K, hx, N]
+    y = y + residuals[torch.randint(len(residuals), (K, hx))]
+    return torch.quantile(y, torch.tensor(q), dim=0)
+
+
+if __name__ == "__main__":
+
+    # python ensemble.py XX [K]
+    from main import load_data, model_paths
+    threshold = None if sys.argv[1] == 'None' else int(sys.argv[1])
+    K = 50 if len(sys.argv) < 3 else int(sys.argv[2]) # ensemble members
+    _, forecast_path = model_paths(threshold)
+    forecast_path = forecast_path.replace('.pickle', '_ensemble.pickle')
+
+    train_size = 200
+    batch_size = 50
+    epochs = 100
+    lr = 0.01
+    p = 1
+    until = 165
+    shape = 'convex_dec'
+    q = (0.05, 0.5, 0.95)
+
+    X, d = load_data()
+    g = build_basis(d, shape, q = threshold, cache = 'cache/basis')
+    members, residuals = train_ensemble(X[:, :train_size], g, p, K, batch_size, epochs, lr, verbose=False)
+    Q = forecast_quantiles(X, g, p, members, residuals, train_size, until, q)
+
+    Y = X[:, train_size: train_size + Q.shape[1]].t()
+    print(f'Median MSE: {((Q[q.index(0.5)] - Y) ** 2).mean():.5f}')
+    print(f'Coverage of [{q[0]}, {q[-1]}]: {((Q[0] <= Y) & (Y <= Q[-1])).float().mean():.3f}')
+    write_pickle([X.numpy(), Q.numpy(), q], forecast_path)
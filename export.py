@@ -0,0 +1,94 @@
+import os, sys
+from utils import *
+from model import Model
+
+
+def load_checkpoint(model_path, N):
+    """
+    Model of a main.py / stationary.py / non_stationary.py checkpoint, its
+    number of basis columns, timesteps and rank are read off the weights
+    """
+    state = torch.load(model_path, map_location='cpu')['model_state_dict']
+    if 'weights' in state:
+        n_basis, T = state['weights'].shape
+        rank = None
+    else:
+        (n_basis, rank), (_, T) = state['U'].shape, state['V'].shape
+    model = Model(N, T, n_basis=n_basis, rank=rank)
+    model.load_state_dict(state)
+    return model
+
+
+def export_weights(model, g, path, top_k=None, chunk=64):
+    """
+    Write the row-stochastic weights W_t = softmax(F[:, t].reshape(N, N)) of
+    all T timesteps to path as a float32 .npy [T, N, N], evaluated chunk
+    timesteps at a time. With top_k, only the k largest weights of each row
+    are kept and renormalized, written as values [T, N, k] to path and their
+    columns [T, N, k] to path with an _idx suffix
+    """
+    N, T = model.N, model.T
+    k = N if top_k is None else min(top_k, N)
+    W = np.lib.format.open_memmap(path, 'w+', np.float32, (T, N, k))
+    if top_k is not None:
+        idx = np.lib.format.open_memmap(path.replace('.npy', '_idx.npy'), 'w+', np.int32, (T, N, k))
+
+    with torch.no_grad():
+        for t in torch.arange(T).split(chunk):
+            w = torch.softmax(model.shape_function(g, t).t().reshape(-1, N, N), -1)
+            if top_k is not None:
+                w, i = w.topk(k, -1)
+                w = w / w.sum(-1, keepdim=True)
+                idx[t.numpy()] = i.numpy()
+            W[t.numpy()] = w.numpy()
+
+    W.flush()
+    if top_k is not None:
+        idx.flush()
+
+
+class FrozenPredictor:
+    """
+    Forecasts from the weights written by export_weights, without the basis.
+    The arrays are memory-mapped, so loading does not read them
+    """
+    def __init__(self, path):
+        # copy-on-write maps: torch shares the pages without a read-only warning
+        self.W = torch.from_numpy(np.load(path, mmap_mode='c'))
+        idx_path = path.replace('.npy', '_idx.npy')
+        self.idx = torch.from_numpy(np.load(idx_path, mmap_mode='c')) if os.path.isfile(idx_path) else None
+        self.T, self.N = self.W.shape[:2]
+
+    def predict(self, x, x_i=None):
+        """
+        x : [b, N, p]
+        x_i : [b, p] timesteps of the inputs, the single W of a stationary model if None
+        Returns the one step ahead forecasts [b, N], as Model.forward
+        """
+        b, N, p = x.shape
+        if x_i is None:
+            x_i = torch.zeros(b, p, dtype=torch.long)
+        x_ = x.transpose(1, 2) # [b, p, N]
+        if self.idx is None:
+            return torch.einsum('bpij,bpj->bi', self.W[x_i], x_)
+        # gather the k inputs of every row, only the gathered indices are cast from int32
+        x_ = x_[torch.arange(b)[:, None, None, None], torch.arange(p)[None, :, None, None], self.idx[x_i].long()]
+        return (self.W[x_i] * x_).sum((1, -1))
+
+
+if __name__ == "__main__":
+
+    # python export.py model/air_XX.pt XX [top_k]
+    model_path = sys.argv[1]
+    threshold = None if sys.argv[2] == 'None' else int(sys.argv[2])
+    top_k = None if len(sys.argv) < 4 else int(sys.argv[3])
+    sample_path = 'data/air/sample.pickle'
+    shape = 'convex_dec'
+
+    _, d = load_pickle(sample_path)
+    g = build_basis(d, shape, q = threshold, cache = 'cache/basis')
+    model = load_checkpoint(model_path, int(np.sqrt(len(d)))) # d holds the N ** 2 pairwise distances
+
+    path = model_path.replace('.pt', '.npy') if top_k is None else model_path.replace('.pt', f'_top{top_k}.npy')
+    export_weights(model, g, path, top_k)
+    print(f'Saved {model.T} weight matrices to {path}')
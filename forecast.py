@@ -1,48 +1,79 @@
-import torch
+import os, hashlib, torch
 from utils import *
 import torch.nn as nn
 import numpy as np
 from tqdm import tqdm
 from model import Model
-from main import generate_data
 
 
 def update(X_new, p, g, model, optimizer, loss_fn):
     x, y, x_i, _ = generate_data(X_new, p)
-    y_hat, F = model(x, x_i, g)
-    optimizer.zero_grad()
-    loss = loss_fn(y_hat, y)
-    loss.backward(retain_graph=True)        
-    optimizer.step()
-    return model, optimizer, F
+    out = {}
+
+    def closure():
+        # L-BFGS evaluates it several times per step, Adam once
+        y_hat, out['F'] = model(x, x_i, g)
+        optimizer.zero_grad()
+        loss = loss_fn(y_hat, y)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return model, optimizer, out['F']
 
     
 def forecast(X, d, p, threshold, train_size, lr, until, epochs, h, 
             model_path, forecast_path, 
-            shape, device):
+            shape, device, basis='dense', compact=False, cache=None, rank=None, solver='adam', resume=True):
     
     # if h = until < train_size: no-retraining
+    # with resume, a run with the same settings continues from its last updated block,
+    # e.g. after an interruption or with a larger until
 
-    g = basis_function(d, shape, q = threshold)
-    g = torch.from_numpy(g).float()
-    if threshold is not None and threshold < 200:
-        g = g.to_sparse()
+    g = build_basis(d, shape, q = threshold, mode = basis, compact = compact, cache = cache)
     
     N, T = X.shape[0], train_size 
 
     input, target, input_indices, _ = generate_data(X, p)
     
-    model = Model(N, T, 1)
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    model = Model(N, T, 1, n_basis=g.shape[1], rank=rank)
+    optimizer = make_optimizer(model.parameters(), solver, lr)
     load_model(model, optimizer, model_path, device)
     loss_fn = nn.MSELoss()
 
-    
+    # Predictions and shape functions are written into buffers of their final
+    # size, at most the last chunk of h steps past until
+    size = min(X.shape[1], train_size + until + h - 1)
+    preds = torch.empty(size, N)
+    Fs = torch.empty(g.shape[0], size)
+
     # Dynamic forecasting
-    preds, F = model(input[:T-p, ], input_indices[:T-p, ], g) 
-    preds = torch.cat((X.t()[:p, :], preds), dim=0)
+    with torch.no_grad():
+        y_hat, F = model(input[:T-p, ], input_indices[:T-p, ], g) 
+    preds[:p] = X.t()[:p, :]
+    preds[p:T] = y_hat
+    Fs[:, :T] = F
+    L = n_F = T
     complete = False
-    Fs = [F]
+
+    checkpoint_path = forecast_path.replace('.pickle', '.ckpt')
+    # content hashes, so a retrained model or other data never resume a stale checkpoint
+    with open(model_path, 'rb') as f:
+        model_hash = hashlib.sha1(f.read()).hexdigest()
+    data_hash = hashlib.sha1(X.detach().contiguous().numpy().tobytes()).hexdigest()
+    config = dict(model_path=model_path, model=model_hash, data=data_hash, threshold=threshold, train_size=train_size,
+                  p=p, h=h, epochs=epochs, lr=lr, shape=shape, basis=basis, compact=compact, rank=rank, solver=solver)
+    if resume and os.path.isfile(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path)
+        if checkpoint['config'] == config and checkpoint['L'] < until + train_size:
+            model.load_state_dict(checkpoint['model_state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            T = L = checkpoint['L']
+            n_F = checkpoint['n_F']
+            preds[:L] = checkpoint['preds']
+            Fs[:, :n_F] = checkpoint['Fs']
+            print(f'Resuming after {L} steps ...')
+    writer = CheckpointWriter(checkpoint_path)
 
 
     
@@ -57,8 +88,8 @@ def forecast(X, d, p, threshold, train_size, lr, until, epochs, h,
             print('Forecasting size:', hx)
             x_i = torch.arange(train_size-hx, train_size).unsqueeze(-1)
             y_hat, _ = model(x, x_i, g)
-            preds = torch.cat((preds, y_hat))
-            L = preds.size(0)
+            preds[L:L + hx] = y_hat
+            L += hx
             remaining = max(0, until + train_size - L)
             print(f'{remaining} steps until completion')
         
@@ -71,26 +102,33 @@ def forecast(X, d, p, threshold, train_size, lr, until, epochs, h,
         if not complete:
             with torch.enable_grad():  
                 model.train()
-                # Update model
+                # Update model, the window is a view of the buffer without a graph
                 print('Updating model ...')
+                X_new = preds[L - train_size:L, ].t()
                 for i in tqdm(range(epochs)):
-                    X_new = preds[-train_size:, ].t()
                     model, optimizer, F = update(X_new, p, g, model, optimizer, loss_fn)
                 
-                Fs.append(F[:, -hx:])
+                Fs[:, n_F:n_F + hx] = F[:, -hx:].detach()
+                n_F += hx
+
+                # clones, views would save the whole buffers
+                writer.submit(dict(checkpoint_state(model, optimizer), config=config, L=L, n_F=n_F,
+                                   preds=preds[:L].clone(), Fs=Fs[:, :n_F].clone()))
         
           
     
-    out = preds.t()
+    writer.close()
+    out = preds[:L].t()
     
     T = X.shape[1]
     out = out[:, :T]
     
-    loss = loss_fn(out, X)
+    loss = loss_fn(out, X[:, :out.size(1)]) # shorter than X if until ends early
     print(loss.item())
 
-    F = torch.cat(Fs, 1)
-    F = F[:, :T].detach().numpy()
-    out = out.detach().numpy()  
+    F = Fs[:, :n_F]
+    F = F[:, :T].numpy()
+    out = out.numpy()  
     X = X.detach().numpy()
-    write_pickle([X, out, F], forecast_path) 
+    write_pickle([X, out, F], forecast_path)
+    return loss.item()
@@ -5,45 +5,24 @@ import pandas as pd
 import torch.nn as nn
 from tqdm import tqdm
 from model import Model
-from torch.utils.data import DataLoader
 
 
 
-def generate_data(X, p):
-    
-    input, target = [], []
-    input_indices = []
-    
-    T = X.size(1)
-    target_indices = torch.arange(p, T) 
-
-    for i in range(p, T):        
-        target.append(X[:, i])
-        input.append(X[:, i-p:i])
-        input_indices.append(torch.arange(i-p, i))
-    
-    return torch.stack(input), torch.stack(target), torch.stack(input_indices), target_indices
-
-def train(X, d, p, threshold, model_path, batch_size, epochs, lr, shape, device='cpu'):
+def train(X, d, p, threshold, model_path, batch_size, epochs, lr, shape, device='cpu', basis='dense', compact=False, cache=None, sparse_grad=False, rank=None, verbose=True, solver='adam', tol=1e-5, patience=None, rel_tol=0.0, recompute=False):
     
     device = torch.device(device if torch.cuda.is_available() else 'cpu')
     
-    g = basis_function(d, shape, q = threshold)
-    g = torch.from_numpy(g).float() # [N ** 2, N ** 2]
-    if threshold is not None and threshold < 200:
-        g = g.to_sparse()
+    g = build_basis(d, shape, q = threshold, mode = basis, compact = compact, cache = cache) # [N ** 2, N ** 2]
     
     N, T = X.shape  
 
     # Generate data 
     # input :  [T - 1, N, 1], target: [T - 1, N], input_indices: [T-1, p], target_indices: [T]
     input, target, input_indices, _ = generate_data(X, p)
-    indices = list(range(T-p))
-    loader = DataLoader(indices, batch_size=batch_size, shuffle=True)
 
     #  Intialize model
-    model = Model(N, T, 1)
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    model = Model(N, T, 1, n_basis=g.shape[1], time_slice=True, sparse_grad=sparse_grad, rank=rank, recompute=recompute)
+    optimizer = make_optimizer(model.parameters(), solver, lr, sparse_grad)
 
     if os.path.isfile(model_path):
         load_model(model, optimizer, model_path, device)
@@ -51,56 +30,94 @@ def train(X, d, p, threshold, model_path, batch_size, epochs, lr, shape, device=
         model.to(device)
 
     loss_fn = nn.MSELoss()
-    prev_loss = 1e+10
+    if solver == 'lbfgs' and patience is None:
+        # stop as soon as a step no longer improves by tol
+        patience, rel_tol = 1, tol
+    stopper = EarlyStopping(patience, rel_tol)
+    writer = CheckpointWriter(model_path)
+    best = None
 
     
+    def closure():
+        # full-batch objective for L-BFGS
+        optimizer.zero_grad()
+        pred, _ = model(input, input_indices, g)
+        loss = loss_fn(pred, target)
+        loss.backward()
+        return loss
+
     for epoch in range(1, epochs + 1):
-        train_losses = 0
-        for idx in tqdm(loader): 
-            y = target[idx, ]
-            x = input[idx, ]
-            x_i = input_indices[idx, ]
-
-            pred, _ = model(x, x_i, g)
-            optimizer.zero_grad()
-            loss = loss_fn(pred, y)
-            loss.backward()
+        if solver == 'lbfgs':
+            optimizer.step(closure)
+            with torch.no_grad():
+                train_loss = loss_fn(model(input, input_indices, g)[0], target).item()
+        else:
+            train_losses = 0
+            loader = batches(T-p, batch_size)
+            for idx in progress(loader, verbose): 
+                y = target[idx, ]
+                x = input[idx, ]
+                x_i = input_indices[idx, ]
+
+                pred, _ = model(x, x_i, g)
+                optimizer.zero_grad()
+                loss = loss_fn(pred, y)
+                loss.backward()
+                
+                optimizer.step()
+                train_losses += loss.item()
             
-            optimizer.step()
-            train_losses += loss.item()
-        
-        train_loss = train_losses / len(loader)
+            train_loss = train_losses / len(loader)
         msg = f"Epoch: {epoch}, Train loss: {train_loss:.5f}"
         print(msg)
-        if train_loss < prev_loss:
+        # save every new lowest loss, stopper.best is the lowest so far
+        if stopper.best is None or train_loss < stopper.best:
             print('Saving model ...')
-            torch.save({'model_state_dict': model.state_dict(),'optimizer_state_dict': optimizer.state_dict(),}, model_path)
-            prev_loss = train_loss
+            best = checkpoint_state(model, optimizer)
+            writer.submit(best)
+        if stopper.step(train_loss):
+            print('Converged !')
+            break
+
+    writer.close()
+    # continue from the best epoch
+    if best is not None:
+        model.load_state_dict(best['model_state_dict'])
+    return model
 
     
 
 
 
-if __name__ == "__main__":
-
-    import psutil, time
-    process = psutil.Process(os.getpid())
-    start = time.time()
-
-    dataset = 'air'
-
-    # Specify quantile value threshold
-    threshold = None if sys.argv[2] == 'None' else int(sys.argv[2])
-
-    sample_path = f'data/{dataset}/sample.pickle'
-    data_path = f'data/{dataset}/data.npy'
+def model_paths(threshold, rank=None, dataset='air'):
     if threshold is None:
         model_path = f'model/{dataset}.pt'
         forecast_path = f'output/{dataset}.pickle'
     else:
         model_path = f'model/{dataset}_{threshold}.pt'
         forecast_path = f'output/{dataset}_{threshold}.pickle'
-    
+    if rank is not None:
+        model_path = model_path.replace('.pt', f'_r{rank}.pt')
+        forecast_path = forecast_path.replace('.pickle', f'_r{rank}.pickle')
+    return model_path, forecast_path
+
+
+def load_data(dataset='air'):
+    sample_path = f'data/{dataset}/sample.pickle'
+    data_path = f'data/{dataset}/data.npy'
+    X = np.load(data_path)
+    _, d = load_pickle(sample_path)
+    X, _  = normalize(X)
+    X = torch.from_numpy(X).float()
+    return X, d
+
+
+def run(phase, threshold, X, d, rank=None, solver='adam', patience=None, rel_tol=0.0, dataset='air'):
+    """
+    Train ('train') or forecast ('val') the real-case model on normalized X,
+    returns the forecast loss
+    """
+    model_path, forecast_path = model_paths(threshold, rank, dataset)
 
     train_size = 200
     batch_size = 50
@@ -108,33 +125,49 @@ if __name__ == "__main__":
     lr = 0.01
     
     p = 1
-
-
-    X = np.load(data_path)
-    _, d = load_pickle(sample_path)
-    X, _  = normalize(X)
-    X = torch.from_numpy(X).float()
          
     X_train = X[:, :train_size]
 
     shape = 'convex_dec'
-
-    if sys.argv[1] == 'train':
-        train(X_train, d, p, threshold, model_path, batch_size, epochs, lr, shape, device='cpu')
+    basis = 'dense' # 'operator' never materializes the basis, 'unique' compresses it over unique distances,
+                    # 'packed' bit-packs monotone_inc / monotone_dec bases
+    compact = False # keep only the threshold quantile columns
+    cache = 'cache/basis' # reuse bases across runs
+    sparse_grad = False # update only the timesteps of each batch
+    recompute = False # rebuild the softmax weights in backward to save memory
+    verbose = False # per-batch progress bars
+
+    if phase == 'train':
+        train(X_train, d, p, threshold, model_path, batch_size, epochs, lr, shape, device='cpu', basis=basis, compact=compact, cache=cache, sparse_grad=sparse_grad, rank=rank, verbose=verbose, solver=solver, patience=patience, rel_tol=rel_tol, recompute=recompute)
     else:
         until = 165
         epochs = 100
         h = until
         from forecast import forecast, update
-        forecast(X, d, p, threshold, train_size, lr, until, epochs, h, model_path, forecast_path, shape, device='cpu')
-    
-    end = time.time()
-    print(f'Start: {time.ctime(start)}, End: {time.ctime(end)}')
-    print(f'{threshold}: {process.memory_info().vms} - Computing time: {end - start} seconds')
-
+        return forecast(X, d, p, threshold, train_size, lr, until, epochs, h, model_path, forecast_path, shape, device='cpu', basis=basis, compact=compact, cache=cache, rank=rank, solver=solver)
 
 
+if __name__ == "__main__":
 
+    import psutil, time
+    process = psutil.Process(os.getpid())
+    start = time.time()
 
+    dataset = 'air'
+    solver = pop_option('--solver', 'adam') # adam / lbfgs
+    # early stopping after --patience epochs without a --rel_tol improvement
+    patience = pop_option('--patience')
+    patience = None if patience is None else int(patience)
+    rel_tol = float(pop_option('--rel_tol', 0.0))
 
+    # Specify quantile value threshold
+    threshold = None if sys.argv[2] == 'None' else int(sys.argv[2])
+    # Optional rank of the factorized weights
+    rank = None if len(sys.argv) < 4 or sys.argv[3] == 'None' else int(sys.argv[3])
 
+    X, d = load_data(dataset)
+    run(sys.argv[1], threshold, X, d, rank, solver, patience, rel_tol, dataset)
+    
+    end = time.time()
+    print(f'Start: {time.ctime(start)}, End: {time.ctime(end)}')
+    print(f'{threshold}: {process.memory_info().vms} - Computing time: {end - start} seconds')
@@ -1,29 +1,98 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from utils import basis_matmul
+
+
+class ColumnGather(torch.autograd.Function):
+    """
+    weights[:, t] for unique sorted t, the gradient is a sparse COO tensor
+    holding only the columns t
+    """
+
+    @staticmethod
+    def forward(ctx, weights, t):
+        ctx.save_for_backward(t)
+        ctx.size = weights.size()
+        return weights[:, t]
+
+    @staticmethod
+    def backward(ctx, grad):
+        t, = ctx.saved_tensors
+        n, u = grad.size()
+        rows = torch.arange(n, device=t.device).repeat_interleave(u)
+        cols = t.repeat(n)
+        grad = torch.sparse_coo_tensor(torch.stack((rows, cols)), grad.reshape(-1), ctx.size,
+                                       is_coalesced=True, check_invariants=False)
+        return grad, None
+
 
 class Model(nn.Module):
-    def __init__(self, N, T, gain=1.0):
+    def __init__(self, N, T, gain=1.0, n_basis=None, time_slice=False, sparse_grad=False, rank=None, recompute=False):
         
         super(Model, self).__init__()
+        if rank is not None and sparse_grad:
+            raise ValueError("Sparse gradients need full-rank weights!")
 
         self.N = N
         self.T = T
+        # only evaluate the shape functions of the timesteps in a batch,
+        # sparse_grad also restricts the gradient to their weight columns
+        self.time_slice = time_slice or sparse_grad
+        self.sparse_grad = sparse_grad
+        self.rank = rank
+        # rebuild F and the softmax weights in backward instead of keeping them for it
+        self.recompute = recompute
 
-        # Defining some parameters        
-        w = torch.empty(N * N, T)       
-        self.weights = nn.Parameter(nn.init.xavier_normal_(w, gain=gain)) # nst sim: 0.008
+        # Defining some parameters, one row per basis column (N ** 2 by default)
+        n_basis = N * N if n_basis is None else n_basis
+        if rank is None:
+            w = torch.empty(n_basis, T)       
+            self.weights = nn.Parameter(nn.init.xavier_normal_(w, gain=gain)) # nst sim: 0.008
+        else:
+            # weights ~ U @ V, parameters grow with (n_basis + T) * rank
+            self.U = nn.Parameter(nn.init.xavier_normal_(torch.empty(n_basis, rank), gain=gain))
+            self.V = nn.Parameter(nn.init.xavier_normal_(torch.empty(rank, T), gain=gain))
+
+    def time_weights(self, t=None):
+        """
+        Weight columns of the timesteps t, all T columns if t is None
+        """
+        if self.rank is not None:
+            V = self.V if t is None else self.V[:, t]
+            return self.U @ V
+        if t is None:
+            return self.weights
+        elif self.sparse_grad:
+            return ColumnGather.apply(self.weights, t)
+        return self.weights[:, t]
+
+    def shape_function(self, g, t=None):
+        """
+        F = g @ weights[:, t] ** 2, all T columns if t is None
+        """
+        return basis_matmul(g, self.time_weights(t) ** 2)
 
     def forward(self, x, x_i, g):
         """
         x : [b, N, p]
         x_i : [b, p]
+        With time_slice, F only holds the columns of the timesteps in x_i
+        With recompute, autograd keeps none of the intermediates, F and the
+        softmax weights are rebuilt from the weights in backward
         """
+        if self.recompute and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, x_i, g, use_reentrant=False)
+        return self._forward(x, x_i, g)
+
+    def _forward(self, x, x_i, g):
     
         # Shape function
-        if g.type() == 'torch.sparse.FloatTensor':
-            F = torch.sparse.mm(g, self.weights ** 2)
+        if self.time_slice:
+            t, x_i = torch.unique(x_i, return_inverse=True)
+            F = self.shape_function(g, t) # [N ** 2, u]
         else:
-            F = torch.matmul(g, self.weights ** 2) # [N ** 2, T]
+            F = self.shape_function(g) # [N ** 2, T]
         
         w = F.t().reshape(-1, self.N, self.N) #[T, N, N]
         w = torch.softmax(w, -1) # [T, N, N]
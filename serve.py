@@ -0,0 +1,195 @@
+import os, sys, json, time, queue, threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils import *
+from export import load_checkpoint, FrozenPredictor
+
+
+class CheckpointPredictor:
+    """
+    Model of a checkpoint with its basis, same interface as FrozenPredictor
+    """
+    def __init__(self, model_path, d, threshold, shape='convex_dec'):
+        self.g = build_basis(d, shape, q = threshold, cache = 'cache/basis')
+        self.model = load_checkpoint(model_path, int(np.sqrt(len(d))))
+        self.model.time_slice = True
+        self.T, self.N = self.model.T, self.model.N
+
+    def predict(self, x, x_i=None):
+        if x_i is None:
+            x_i = torch.zeros(x.shape[0], x.shape[2], dtype=torch.long)
+        return self.model(x, x_i, self.g)[0]
+
+
+class MicroBatcher:
+    """
+    Serves the requests of one model from a single thread. Requests that
+    arrive within max_wait seconds of each other, up to max_batch rows, are
+    concatenated into one predict call
+    """
+    def __init__(self, predictor, max_batch=256, max_wait=0.002):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen=10000)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, x, x_i):
+        job = {'x': x, 'x_i': x_i, 'done': threading.Event()}
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['y']
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            n = len(jobs[0]['x'])
+            deadline = time.perf_counter() + self.max_wait
+            while n < self.max_batch:
+                try:
+                    job = self.queue.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                n += len(job['x'])
+
+            # only requests with the same number of lags share a batch
+            for p in {job['x'].shape[2] for job in jobs}:
+                self.predict([job for job in jobs if job['x'].shape[2] == p])
+
+    def predict(self, jobs):
+        try:
+            x = torch.cat([job['x'] for job in jobs])
+            x_i = torch.cat([job['x_i'] for job in jobs])
+            with torch.no_grad():
+                y = self.predictor.predict(x, x_i)
+            self.batch_sizes.append(len(x))
+            for job, y_ in zip(jobs, y.split([len(job['x']) for job in jobs])):
+                job['y'] = y_
+        except Exception as e:
+            for job in jobs:
+                job['error'] = e
+        for job in jobs:
+            job['done'].set()
+
+
+class ForecastServer(ThreadingHTTPServer):
+    """
+    Localhost HTTP server of resident models
+      POST /forecast {"model": name, "x": [b, N, p], "t": [b, p] (optional)} -> {"y": [b, N]}
+      GET /health, GET /metrics
+    Without t, the inputs are the last p steps of the training window, i.e. y is the next step
+    """
+    daemon_threads = True
+
+    def __init__(self, predictors, port=8000, max_batch=256, max_wait=0.002):
+        super().__init__(('127.0.0.1', port), ForecastHandler)
+        self.batchers = {name: MicroBatcher(p, max_batch, max_wait) for name, p in predictors.items()}
+        self.start = time.time()
+        self.latencies = deque(maxlen=10000)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'errors': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def forecast(self, request):
+        batcher = self.batchers.get(request.get('model'))
+        if batcher is None:
+            raise LookupError(f"Unknown model {request.get('model')}!")
+        T, N = batcher.predictor.T, batcher.predictor.N
+        x = torch.tensor(request['x'], dtype=torch.float32)
+        if x.dim() != 3 or x.shape[1] != N:
+            raise ValueError(f"x must be [b, {N}, p]!")
+        b, _, p = x.shape
+        if 't' in request:
+            x_i = torch.tensor(request['t'], dtype=torch.long)
+            if x_i.shape != (b, p) or (x_i < 0).any() or (x_i >= T).any():
+                raise ValueError(f"t must be [{b}, {p}] timesteps below {T}!")
+        else:
+            x_i = torch.arange(T - p, T).clamp(min=0).expand(b, p)
+        return batcher.submit(x, x_i).tolist()
+
+    def metrics(self):
+        ms = np.array(self.latencies) * 1e3
+        sizes = [s for batcher in self.batchers.values() for s in batcher.batch_sizes]
+        return dict(self.counts,
+                    latency_ms={f'p{q}': float(np.percentile(ms, q)) for q in (50, 90, 99)} if len(ms) else {},
+                    mean_batch_size=float(np.mean(sizes)) if sizes else 0.0)
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/health':
+            models = {name: {'N': b.predictor.N, 'T': b.predictor.T} for name, b in server.batchers.items()}
+            self.reply(200, {'status': 'ok', 'uptime': time.time() - server.start, 'models': models})
+        elif self.path == '/metrics':
+            self.reply(200, server.metrics())
+        else:
+            self.reply(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        server = self.server
+        if self.path != '/forecast':
+            return self.reply(404, {'error': f'Unknown path {self.path}'})
+        start = time.perf_counter()
+        server.count('requests')
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            y = server.forecast(request)
+        except KeyError as e:
+            server.count('errors')
+            return self.reply(400, {'error': f'Missing field {e}'})
+        except LookupError as e:
+            server.count('errors')
+            return self.reply(404, {'error': str(e)})
+        except (ValueError, TypeError, AttributeError, RuntimeError) as e:
+            server.count('errors')
+            return self.reply(400, {'error': str(e)})
+        server.latencies.append(time.perf_counter() - start)
+        self.reply(200, {'y': y})
+
+    def log_message(self, format, *args):
+        pass # one line per request is too much for a forecast service
+
+
+if __name__ == "__main__":
+
+    # python serve.py [--port 8000] name=model/air_XX.npy name=model/air_XX.pt,XX ...
+    # .npy files are exported by export.py, checkpoints need their threshold
+    port = int(pop_option('--port', 8000))
+    max_batch = int(pop_option('--max_batch', 256)) # rows per forward
+    max_wait = float(pop_option('--max_wait', 0.002)) # seconds to wait for concurrent requests
+    sample_path = 'data/air/sample.pickle'
+
+    predictors = {}
+    for arg in sys.argv[1:]:
+        name, path = arg.split('=', 1)
+        if path.endswith('.npy'):
+            predictors[name] = FrozenPredictor(path)
+        else:
+            path, threshold = path.split(',')
+            _, d = load_pickle(sample_path)
+            predictors[name] = CheckpointPredictor(path, d, None if threshold == 'None' else int(threshold))
+
+    torch.set_num_threads(1) # requests are batched instead
+    server = ForecastServer(predictors, port, max_batch, max_wait)
+    print(f'Serving {", ".join(predictors)} on http://127.0.0.1:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -3,38 +3,23 @@ from utils import *
 import pandas as pd
 import torch.nn as nn
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 
-threshold = None if sys.argv[4] == 'None' else int(sys.argv[4])
-
-
-def generate_data(X, p):
-    T = X.size(1)
-    input = []
-    target = []
-    for i in range(p, T):
-        target.append(X[:, i])
-        input.append(X[:, i-p:i])
-    return torch.stack(input), torch.stack(target)
 
 class Model(nn.Module):
-    def __init__(self, input_size):
+    def __init__(self, input_size, n_basis=None):
         super(Model, self).__init__()
 
         self.N = input_size
 
-        # Define parameters
-        weights = torch.empty(input_size * input_size, 1)
+        # Define parameters, one row per basis column (N ** 2 by default)
+        n_basis = input_size * input_size if n_basis is None else n_basis
+        weights = torch.empty(n_basis, 1)
         self.weights = nn.Parameter(nn.init.xavier_normal_(weights)) # 0.015
 
     def forward(self, x, g):
         
-        g.requires_grad = False
-        if g.type() == 'torch.sparse.FloatTensor':
-            f = torch.sparse.mm(g, self.weights ** 2)
-        else:
-            f = torch.matmul(g, self.weights ** 2) # [N ** 2, T]
+        f = basis_matmul(g, self.weights ** 2) # [N ** 2, 1]
         
         w = f.reshape(self.N, self.N) 
         w = torch.softmax(w, -1) # add minus sign if increasing
@@ -45,22 +30,18 @@ class Model(nn.Module):
 
 
 
-def train(X, d, p, batch_size, epochs, lr, model_path, shape, device='cpu'):
+def train(X, d, p, threshold, batch_size, epochs, lr, model_path, shape, device='cpu', basis='dense', compact=False, cache=None, verbose=True, solver='adam', tol=1e-5, patience=None, rel_tol=0.0):
     
     device = torch.device(device if torch.cuda.is_available() else 'cpu')
     
     # q is q-quantile value, if q is None, compute order statistics instead
-    g = basis_function(d, shape, q = threshold) 
-    g = torch.from_numpy(g).float()
-    
-    if threshold is not None and threshold < 200:
-        g = g.to_sparse()
+    g = build_basis(d, shape, q = threshold, mode = basis, compact = compact, cache = cache) 
     
     N, T = X.shape   
     V = 50
     
-    model = Model(N)
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    model = Model(N, n_basis=g.shape[1])
+    optimizer = make_optimizer(model.parameters(), solver, lr)
     if os.path.isfile(model_path):
         load_model(model, optimizer, model_path, device)
     else:
@@ -73,54 +54,81 @@ def train(X, d, p, batch_size, epochs, lr, model_path, shape, device='cpu'):
 
 
     # Generate data 
-    input, target = generate_data(X, p)
-    loader = DataLoader(list(range(T-p-V)), batch_size=batch_size, shuffle=True)
+    input, target, _, _ = generate_data(X, p)
+    if solver == 'lbfgs' and patience is None:
+        # stop as soon as a step no longer improves by tol
+        patience, rel_tol = 1, tol
+    stopper = EarlyStopping(patience, rel_tol)
+    writer = CheckpointWriter(model_path)
+    best = None
+
+    def closure():
+        # full-batch objective for L-BFGS
+        optimizer.zero_grad()
+        pred, _ = model(input[:T-p-V], g)
+        loss = loss_fn(pred.squeeze(-1), target[:T-p-V])
+        loss.backward()
+        return loss
 
     for epoch in range(1, epochs + 1):
-        train_losses = 0
-        val_losses = 0
-        for idx in tqdm(loader): 
-            y = target[idx,]
-            x = input[idx, ]
-            pred, _ = model(x, g)
-            pred = pred.squeeze(-1)
-            optimizer.zero_grad()
-            loss = loss_fn(pred, y)
-            loss.backward()
-                        
-            optimizer.step()
-            train_losses += loss.item()
+        if solver == 'lbfgs':
+            optimizer.step(closure)
+            with torch.no_grad():
+                pred, _ = model(input[:T-p-V], g)
+                train_loss = loss_fn(pred.squeeze(-1), target[:T-p-V]).item()
+        else:
+            train_losses = 0
+            loader = batches(T-p-V, batch_size)
+            for idx in progress(loader, verbose): 
+                y = target[idx,]
+                x = input[idx, ]
+                pred, _ = model(x, g)
+                pred = pred.squeeze(-1)
+                optimizer.zero_grad()
+                loss = loss_fn(pred, y)
+                loss.backward()
+                            
+                optimizer.step()
+                train_losses += loss.item()
+            train_loss = train_losses / len(loader)
             
         pred, _ = model(input[-V:, ], g)
         pred = pred.squeeze(-1)
         val_loss = loss_fn(pred, target[-V:, ])
             
-        train_loss = train_losses / len(loader)
         msg = f"Epoch: {epoch}, Train loss: {train_loss:.5f}, Val loss: {val_loss:.5f}"
         print(msg)        
         
         if train_loss < tloss and val_loss <= vloss:
             print('Saving model ...')
-            torch.save({'model_state_dict': model.state_dict(),'optimizer_state_dict': optimizer.state_dict(),}, model_path)
+            best = checkpoint_state(model, optimizer)
+            writer.submit(best)
             tloss = train_loss
             vloss = val_loss
+        if stopper.step(train_loss):
+            print('Converged !')
+            break
+
+    writer.close()
+    # continue from the best epoch
+    if best is not None:
+        model.load_state_dict(best['model_state_dict'])
+    return model
         
 
-def forecast(X, d, p, model_path, forecast_path, shape, device='cpu'):
+def forecast(X, d, p, threshold, model_path, forecast_path, shape, device='cpu', basis='dense', compact=False, cache=None):
 
-    g = basis_function(d, shape, q = threshold)
-    g = torch.from_numpy(g).float()
-    g = g.to_sparse()
+    g = build_basis(d, shape, q = threshold, mode = basis, sparse = True, compact = compact, cache = cache)
     
     
     #  Intialize model
     N, T = X.shape 
     loss_fn = nn.MSELoss()
-    model = Model(N)
+    model = Model(N, n_basis=g.shape[1])
     load_model(model, None, model_path, device)
 
     Xts = torch.from_numpy(X).float()
-    input, target = generate_data(Xts, p)
+    input, target, _, _ = generate_data(Xts, p)
     
     
     print('Predicting ...')
@@ -136,18 +144,13 @@ def forecast(X, d, p, model_path, forecast_path, shape, device='cpu'):
     
     F = F.detach().numpy()
     write_pickle([X, out, F], forecast_path) 
-    
-    
-
+    return loss.item()
 
-if __name__ == "__main__":
 
-    sample_path = 'data/sample.pickle'
-    data_path = sys.argv[1]
-    forecast_path = sys.argv[2]
-    model_path = sys.argv[3]
-    
-    
+def run(data_path, forecast_path, model_path, threshold, d, solver='adam', patience=None, rel_tol=0.0):
+    """
+    Train and forecast the simulation in data_path, returns the forecast loss
+    """
     df = pd.read_csv(data_path)
     X = df.iloc[:, 1:].to_numpy()
 
@@ -158,17 +161,33 @@ if __name__ == "__main__":
     
     p = 1
 
-    _, d = load_pickle(sample_path)
-                
     X_train = X[:, :train_size]  
     X_train = torch.from_numpy(X_train).float()
 
     shape = 'convex_dec'
+    basis = 'dense' # 'operator' never materializes the basis, 'unique' compresses it over unique distances,
+                    # 'packed' bit-packs monotone_inc / monotone_dec bases
+    compact = False # keep only the threshold quantile columns
+    cache = 'cache/basis' # reuse bases across runs
+    verbose = False # per-batch progress bars
 
-    train(X_train, d, p, batch_size, epochs, lr, model_path, shape, device='cpu')
-    forecast(X, d, p, model_path, forecast_path, shape)
-
+    train(X_train, d, p, threshold, batch_size, epochs, lr, model_path, shape, device='cpu', basis=basis, compact=compact, cache=cache, verbose=verbose, solver=solver, patience=patience, rel_tol=rel_tol)
+    return forecast(X, d, p, threshold, model_path, forecast_path, shape, basis=basis, compact=compact, cache=cache)
+    
 
 
+if __name__ == "__main__":
 
+    sample_path = 'data/sample.pickle'
+    solver = pop_option('--solver', 'adam') # adam / lbfgs
+    # early stopping after --patience epochs without a --rel_tol improvement
+    patience = pop_option('--patience')
+    patience = None if patience is None else int(patience)
+    rel_tol = float(pop_option('--rel_tol', 0.0))
+    data_path = sys.argv[1]
+    forecast_path = sys.argv[2]
+    model_path = sys.argv[3]
+    threshold = None if sys.argv[4] == 'None' else int(sys.argv[4])
 
+    _, d = load_pickle(sample_path)
+    run(data_path, forecast_path, model_path, threshold, d, solver, patience, rel_tol)
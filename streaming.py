@@ -0,0 +1,136 @@
+import os, sys, time
+from collections import deque
+from utils import *
+import torch.nn as nn
+from model import Model
+
+
+class StreamingForecaster:
+    """
+    Online version of forecast.forecast for live feeds. The last T
+    observations are kept in a ring buffer and every observe(x_t) makes a
+    fixed number of gradient steps on a mini-batch of its windows (always
+    holding the newest one) instead of retraining for full epochs, so the
+    cost of an observation does not grow with T or the stream length.
+    model : trained Model(N, T), X : [N, >= T] initial data, its last T columns are kept
+    """
+    def __init__(self, model, optimizer, g, X, p=1, steps=1, batch_size=32, max_latencies=10000):
+        self.model = model
+        self.optimizer = optimizer
+        self.g = g
+        self.p = p
+        self.steps = steps
+        self.batch_size = batch_size
+        self.N, self.T = model.N, model.T
+        self.loss_fn = nn.MSELoss()
+        # gradient steps only evaluate the shape functions of their batch
+        self.model.time_slice = True
+
+        # every observation is written at i and i + T, the window is the view [i + 1, i + T + 1)
+        X = torch.as_tensor(X, dtype=torch.float32)[:, -self.T:]
+        self.buffer = torch.cat((X, X), 1)
+        self.i = self.T - 1
+        self.latencies = {'observe': deque(maxlen=max_latencies), 'predict': deque(maxlen=max_latencies)}
+
+    def window(self):
+        # last T observations in time order [N, T], a view of the buffer
+        return self.buffer[:, self.i + 1: self.i + 1 + self.T]
+
+    def observe(self, x_t):
+        """
+        Append x_t : [N] and update the model on the new window, returns the last loss
+        """
+        start = time.perf_counter()
+        self.i = (self.i + 1) % self.T
+        self.buffer[:, self.i] = self.buffer[:, self.i + self.T] = torch.as_tensor(x_t)
+        loss = self.update()
+        self.latencies['observe'].append(time.perf_counter() - start)
+        return loss
+
+    def update(self):
+        x, y, x_i, _ = generate_data(self.window(), self.p)
+        n = y.size(0)
+        loss = None
+
+        for _ in range(self.steps):
+            idx = torch.randperm(n - 1)[:self.batch_size - 1]
+            idx = torch.cat((idx, torch.tensor([n - 1])))
+
+            def closure():
+                self.optimizer.zero_grad()
+                pred, _ = self.model(x[idx], x_i[idx], self.g)
+                loss = self.loss_fn(pred, y[idx])
+                loss.backward()
+                return loss
+
+            loss = self.optimizer.step(closure)
+        return None if loss is None else loss.item()
+
+    def predict(self, h=1):
+        """
+        Forecast the next h steps [N, h] from the window, each prediction is
+        fed back as the input of the next one. As in forecast.forecast, step k
+        uses the weights of the last h columns, so h + p - 1 <= T
+        """
+        if h + self.p - 1 > self.T:
+            raise ValueError(f"Cannot forecast more than {self.T - self.p + 1} steps!")
+        start = time.perf_counter()
+        N, p = self.N, self.p
+
+        with torch.no_grad():
+            t = torch.arange(self.T - h - p + 1, self.T)
+            w = self.model.shape_function(self.g, t).t().reshape(-1, N, N)
+            w = torch.softmax(w, -1) # [h + p - 1, N, N]
+            x = list(self.window()[:, -p:].t())
+            preds = torch.empty(N, h)
+            for k in range(h):
+                y = sum(w[k + j] @ x[j - p] for j in range(p))
+                preds[:, k] = y
+                x.append(y)
+
+        self.latencies['predict'].append(time.perf_counter() - start)
+        return preds
+
+    def latency(self, q=(50, 90, 99)):
+        """
+        Percentiles q of the recent observe / predict latencies in milliseconds
+        """
+        return {k: dict(zip(q, np.percentile(np.array(v) * 1e3, q))) if v else {}
+                for k, v in self.latencies.items()}
+
+
+if __name__ == "__main__":
+
+    # Replay the air data after the training window, e.g. python streaming.py XX
+    # with model/air_XX.pt trained by main.py
+    from main import load_data, model_paths
+
+    threshold = None if sys.argv[1] == 'None' else int(sys.argv[1])
+    model_path, _ = model_paths(threshold)
+
+    train_size = 200
+    lr = 0.01
+    p = 1
+    shape = 'convex_dec'
+    steps = 1 # gradient steps per observation
+    batch_size = 32
+    h = 1
+
+    X, d = load_data()
+    g = build_basis(d, shape, q = threshold, cache = 'cache/basis')
+    N = X.shape[0]
+
+    model = Model(N, train_size, 1, n_basis=g.shape[1])
+    optimizer = make_optimizer(model.parameters(), 'adam', lr)
+    load_model(model, optimizer, model_path, 'cpu')
+
+    stream = StreamingForecaster(model, optimizer, g, X[:, :train_size], p, steps, batch_size)
+    errors = []
+    for t in range(train_size, X.shape[1] - h + 1):
+        y_hat = stream.predict(h)
+        errors.append(((y_hat - X[:, t:t + h]) ** 2).mean().item())
+        stream.observe(X[:, t])
+
+    print(f'{h}-step MSE: {np.mean(errors):.5f}')
+    for k, v in stream.latency().items():
+        print(k, ', '.join(f'p{q}: {ms:.3f} ms' for q, ms in v.items()))
@@ -0,0 +1,109 @@
+import os, sys, time
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context, shared_memory
+from utils import *
+import pandas as pd
+
+
+def share(array):
+    """
+    Copy array into a new shared memory block, returns the block and its spec
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach(spec):
+    # view of a block created by share(), its creator unlinks it
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+_shared = {}
+
+
+def init_worker(X_spec, d_spec, threads):
+    torch.set_num_threads(threads)
+    shm_X, X = attach(X_spec)
+    shm_d, d = attach(d_spec)
+    # shared by all workers, nothing writes to it
+    _shared.update(shm=(shm_X, shm_d), X=torch.from_numpy(X), d=d)
+
+
+def run_job(phase, threshold, log_dir, kwargs):
+    import main
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f'{threshold}_{phase}.log'), 'w') as log, redirect_stdout(log):
+        loss = main.run(phase, threshold, _shared['X'], _shared['d'], **kwargs)
+    return phase, threshold, time.perf_counter() - start, loss
+
+
+def sweep(thresholds, workers, threads, dataset='air', log_dir='output/sweep', **kwargs):
+    """
+    Train and forecast every threshold on a process pool. Jobs whose model
+    (train) or forecast (val) file exists are skipped, a forecast is scheduled
+    once its model is trained. kwargs (rank, solver, ...) go to main.run.
+    Returns a table of timings and forecast losses
+    """
+    from main import load_data, model_paths
+    os.makedirs(log_dir, exist_ok=True)
+    # the jobs write the model and forecast files of this dataset
+    kwargs['dataset'] = dataset
+
+    X, d = load_data(dataset)
+    shm_X, X_spec = share(X.numpy())
+    shm_d, d_spec = share(np.asarray(d))
+
+    rows = {t: {'threshold': t, 'train_s': None, 'val_s': None, 'mse': None} for t in thresholds}
+    try:
+        with ProcessPoolExecutor(workers, mp_context=get_context('spawn'), initializer=init_worker,
+                                 initargs=(X_spec, d_spec, threads)) as pool:
+            def submit(phase, t):
+                return pool.submit(run_job, phase, t, log_dir, kwargs)
+
+            pending = set()
+            for t in thresholds:
+                model_path, forecast_path = model_paths(t, kwargs.get('rank'), dataset)
+                if not os.path.isfile(model_path):
+                    pending.add(submit('train', t))
+                elif not os.path.isfile(forecast_path):
+                    pending.add(submit('val', t))
+                else:
+                    print(f'Skipping {t}: {forecast_path} exists')
+                    X_, out, _ = load_pickle(forecast_path)
+                    # same loss as forecast.forecast, out ends with until
+                    rows[t]['mse'] = float(((out - X_[:, :out.shape[1]]) ** 2).mean())
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for job in done:
+                    phase, t, seconds, loss = job.result()
+                    print(f'{t} {phase}: {seconds:.1f} seconds')
+                    rows[t][f'{phase}_s'] = seconds
+                    if phase == 'train':
+                        pending.add(submit('val', t))
+                    else:
+                        rows[t]['mse'] = loss
+    finally:
+        for shm in (shm_X, shm_d):
+            shm.close()
+            shm.unlink()
+
+    table = pd.DataFrame(rows.values())
+    table.to_csv(os.path.join(log_dir, 'sweep.csv'), index=False)
+    return table
+
+
+if __name__ == "__main__":
+
+    # python sweep.py [--workers W] [--threads K] [thresholds ...]
+    workers = int(pop_option('--workers', os.cpu_count()))
+    threads = int(pop_option('--threads', 1))
+    solver = pop_option('--solver', 'adam')
+    thresholds = [None if t == 'None' else int(t) for t in sys.argv[1:]] or [10, 50, 100, 150, 200, 300]
+
+    table = sweep(thresholds, workers, threads, solver=solver)
+    print(table.to_string(index=False))
@@ -1,6 +1,8 @@
-import pickle
+import os, sys, copy, pickle, threading
 import numpy as np
 import torch
+from tqdm import tqdm
+from cache import BasisCache
 
 def load(datadir):
     with open(datadir, encoding='utf-8') as f:
@@ -17,14 +19,151 @@ def write_pickle(data, savedir):
   pickle.dump(data, file)
   file.close()
 
+def checkpoint_state(model, optimizer):
+  # detached copy of the current model and optimizer states
+  return {'model_state_dict': {k: v.detach().clone() for k, v in model.state_dict().items()},
+          'optimizer_state_dict': copy.deepcopy(optimizer.state_dict()),
+          'optimizer': type(optimizer).__name__}
+
+
+class CheckpointWriter:
+  """
+  Writes checkpoints on a background thread. Only the latest submitted state
+  is persisted, states submitted while a write is in progress replace each other.
+  A failed write is raised by the next submit() or close()
+  """
+  def __init__(self, model_path):
+      self.model_path = model_path
+      self.state = None
+      self.closed = False
+      self.error = None
+      self.cond = threading.Condition()
+      self.thread = threading.Thread(target=self._run, daemon=True)
+      self.thread.start()
+
+  def submit(self, state):
+      self.raise_error()
+      with self.cond:
+          self.state = state
+          self.cond.notify()
+
+  def _run(self):
+      while True:
+          with self.cond:
+              while self.state is None and not self.closed:
+                  self.cond.wait()
+              if self.state is None:
+                  return
+              state, self.state = self.state, None
+          tmp = f'{self.model_path}.tmp'
+          try:
+              torch.save(state, tmp)
+              os.replace(tmp, self.model_path)
+          except Exception as e:
+              self.error = e
+
+  def close(self):
+      # flush the pending state and stop the thread
+      with self.cond:
+          self.closed = True
+          self.cond.notify()
+      self.thread.join()
+      self.raise_error()
+
+  def raise_error(self):
+      if self.error is not None:
+          error, self.error = self.error, None
+          raise error
+
+
+class EarlyStopping:
+  """
+  Stops after `patience` epochs without a relative improvement of rel_tol,
+  patience None never stops
+  """
+  def __init__(self, patience=None, rel_tol=0.0):
+      self.patience = patience
+      self.rel_tol = rel_tol
+      self.best = None
+      self.wait = 0
+
+  def step(self, loss):
+      # the first loss always counts as an improvement
+      if self.best is None or loss < self.best - self.rel_tol * abs(self.best):
+          self.wait = 0
+      else:
+          self.wait += 1
+      self.best = loss if self.best is None else min(self.best, loss)
+      return self.patience is not None and self.wait >= self.patience
+
+def make_optimizer(params, solver, lr, sparse_grad=False):
+  """
+  solver : 'adam' for mini-batches (SparseAdam with sparse gradients),
+           'lbfgs' for full-batch quasi-Newton steps with a strong Wolfe line search,
+           which picks its own step size and ignores lr
+  """
+  if solver == 'adam':
+      if sparse_grad:
+          # SparseAdam only updates the weight columns (and moments) a batch touches
+          return torch.optim.SparseAdam(params, lr=lr)
+      return torch.optim.Adam(params, lr=lr)
+  elif solver == 'lbfgs':
+      if sparse_grad:
+          raise ValueError("L-BFGS needs dense gradients!")
+      return torch.optim.LBFGS(params, lr=1, max_iter=20, history_size=10,
+                               tolerance_grad=1e-7, tolerance_change=1e-9,
+                               line_search_fn='strong_wolfe')
+  raise ValueError("Unknown solver!")
+
+def pop_option(name, default=None):
+  """
+  Remove `--name value` (or `--name=value`) from sys.argv and return value
+  """
+  for i, arg in enumerate(sys.argv):
+      if arg == name and i + 1 < len(sys.argv):
+          value = sys.argv[i + 1]
+          del sys.argv[i:i + 2]
+          return value
+      if arg.startswith(name + '='):
+          del sys.argv[i]
+          return arg.split('=', 1)[1]
+  return default
+
 def load_model(model, optimizer, model_path, device):
   checkpoint = torch.load(model_path, map_location=device)
   model.load_state_dict(checkpoint['model_state_dict'])
   model.to(device)
-  if optimizer:
+  # optimizer states only carry over between the same optimizer, e.g. not SparseAdam -> Adam
+  if optimizer and checkpoint.get('optimizer', 'Adam') == type(optimizer).__name__:
       optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
 
+def generate_data(X, p):
+  """
+  Sliding windows of p lags over X [..., N, T], as strided views of X:
+  input : [..., T - p, N, p], target : [..., T - p, N], input_indices : [T - p, p], target_indices : [T - p]
+  """
+  T = X.size(-1)
+  input = X.unfold(-1, p, 1)[..., :T - p, :].transpose(-3, -2)
+  target = X[..., p:].transpose(-1, -2)
+  input_indices = torch.arange(T).as_strided((T - p, p), (1, 1))
+  target_indices = torch.arange(p, T)
+  return input, target, input_indices, target_indices
+
+
+def batches(n, batch_size, shuffle=True):
+  """
+  Mini-batches of index tensors over range(n), without a DataLoader collate
+  """
+  idx = torch.randperm(n) if shuffle else torch.arange(n)
+  return idx.split(batch_size)
+
+
+def progress(iterable, verbose=True):
+  # per-batch progress bar, skipped in quiet mode
+  return tqdm(iterable) if verbose else iterable
+
+
 def moving_average_standardize(W, n):
   T = W.shape[0]
   std_W = (W[:n, :] - W[:n, :].mean())/W[:n, :].std() 
@@ -35,55 +174,376 @@ def moving_average_standardize(W, n):
   return std_W
 
 
-def get_quantiles(d, q):
+def get_quantiles(d, q, tie = 'first'):
+  """
+  q quantile values of d and the index of the entry closest to each of them.
+  tie : 'first' picks the lowest index among all closest entries (as argmin),
+        'lower' prefers the smaller of two equally close values
+  """
   r = np.arange(q) / q
   qr = np.quantile(d, r)
-  idx = [(np.abs(d - i)).argmin() for i in qr] # selected indices
+
+  # stable sort: equal values keep their original order
+  order = np.argsort(d, kind='stable')
+  sorted_d = d[order]
+  hi = np.minimum(np.searchsorted(sorted_d, qr), d.shape[0] - 1)
+  lo = np.maximum(hi - 1, 0)
+  dist_lo = np.abs(sorted_d[lo] - qr)
+  dist_hi = np.abs(sorted_d[hi] - qr)
+
+  # lowest index holding each candidate value
+  idx_lo = order[np.searchsorted(sorted_d, sorted_d[lo])]
+  idx_hi = order[np.searchsorted(sorted_d, sorted_d[hi])]
+  if tie == 'first':
+    tied = np.minimum(idx_lo, idx_hi)
+  elif tie == 'lower':
+    tied = idx_lo
+  else:
+    raise ValueError("Unknown tie-breaking mode!")
+
+  idx = np.where(dist_lo < dist_hi, idx_lo, np.where(dist_hi < dist_lo, idx_hi, tied)) # selected indices
   return qr, idx 
 
-def basis_function(d, shape, q = None):
-    
-    m = d.shape[0]
+
+shapes = ('monotone_inc', 'concave_inc', 'monotone_dec', 'convex_dec')
+
+
+def basis_knots(d, q = None, compact = False):
+    """
+    Knots of the basis columns and the rows zeroed out in quantile mode,
+    compact keeps only the q quantile knots
+    """
     if q is None:
       print('Applying order statistics ...')
       # order statistics as usual
-      sorted_d = np.sort(d)
+      return np.sort(d), None
+    print('Applying quantiles ...')
+    # get quantile values
+    qr, idx = get_quantiles(d, q)
+    sorted_idx = np.sort(idx)
+    sorted_d = np.zeros_like(d)
+    sorted_d[sorted_idx] = qr
+    if compact:
+      return sorted_d[sorted_idx], idx
+    return sorted_d, idx
+
+
+def _shape_columns(d, knots, shape, out=None):
+    """
+    Evaluate a shape function at distances d [m] for every knot [k] -> [m, k]
+    """
+    if out is None:
+        out = np.empty((d.shape[0], knots.shape[0]))
+    d = d[:, None]
+    knots = knots[None, :]
+    if shape == 'monotone_inc': #2
+        a = np.greater_equal(d, knots, out=out)
+        b = (knots <= 0.0).astype('int')
+        return np.subtract(a, b, out=a)
+    elif shape == 'concave_inc': #7
+        a = np.less_equal(d, knots, out=out)
+        gx = np.multiply(d - knots, a, out=a)
+        return np.add(gx, knots * (knots >= 0.0).astype('int'), out=gx)
+    elif shape == 'monotone_dec': #3
+        a = np.less_equal(d, knots, out=out)
+        b = 0 # int(sorted_d[i] > 0.0) 
+        return np.subtract(a, b, out=a)
+    elif shape == 'convex_dec': #6
+        a = np.less_equal(d, knots, out=out)
+        return np.multiply(knots - d, a, out=a) # - sorted_d[i] * int(sorted_d[i] >= 0.0) 
     else:
-      print('Applying quantiles ...')
-      # get quantile values
-      qr, idx = get_quantiles(d, q)
-      sorted_idx = np.sort(idx)
-      sorted_d = np.zeros_like(d)
-      sorted_d[sorted_idx] = qr
-
-    g = []
-    for i in range(m):
-        if shape == 'monotone_inc': #2
-            a = (d >= sorted_d[i]).astype('float')
-            b = int(sorted_d[i] <= 0.0) 
-            g.append(a - b)
-        elif shape == 'concave_inc': #7
-            a = (d <= sorted_d[i]).astype('float')
-            gx = np.multiply(d-sorted_d[i], a) + sorted_d[i] * int(sorted_d[i] >= 0.0) 
-            g.append(gx)
-        elif shape == 'monotone_dec': #3
-            a = (d <= sorted_d[i]).astype('float')
-            b = 0 # int(sorted_d[i] > 0.0) 
-            g.append(a - b)
-        elif shape == 'convex_dec': #6
-            a = (d <= sorted_d[i]).astype('float')
-            gx = np.multiply(sorted_d[i]-d, a) # - sorted_d[i] * int(sorted_d[i] >= 0.0) 
-            g.append(gx)
-        else:
-          raise ValueError("Unknown shape!")
-    
-    g = np.stack(g, axis=1)
-    if q is not None:
+        raise ValueError("Unknown shape!")
+
+
+def basis_function(d, shape, q = None, max_bytes = 2 ** 28, compact = False):
+    """
+    Build the [m, m] shape-function basis block by block of rows,
+    `max_bytes` bounds the temporaries allocated per block.
+    With compact quantiles, only the q informative columns are kept: [m, q]
+    """
+    sorted_d, idx = basis_knots(d, q, compact)
+    g = _evaluate_basis(d, sorted_d, shape, max_bytes)
+
+    if idx is not None:
       g[idx, ] = 0
 
     return g
 
 
+def _evaluate_basis(d, knots, shape, max_bytes = 2 ** 28):
+    # [m, k] basis filled block by block of rows
+    if shape not in shapes:
+      raise ValueError("Unknown shape!")
+
+    m, k = d.shape[0], knots.shape[0]
+    block = max(1, min(m, max_bytes // (8 * max(k, 1))))
+    g = np.empty((m, k))
+    for start in range(0, m, block):
+        stop = min(start + block, m)
+        _shape_columns(d[start:stop], knots, shape, out=g[start:stop])
+    return g
+
+
+class ShapeBasisFunction(torch.autograd.Function):
+    """
+    F = g @ W for a ShapeBasisOperator g, with sorted cumulative sums
+    """
+
+    @staticmethod
+    def forward(ctx, W, op):
+        ctx.op = op
+        return op._matmul(W)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return ctx.op._rmatmul(grad), None
+
+
+class ShapeBasisOperator:
+    """
+    Matrix-free basis: every shape is a step or hinge function of the knots,
+    so g @ W is evaluated in O(m log m) time and O(m) memory
+    d : [m], g : [m, k]
+    """
+    def __init__(self, d, shape, q = None, compact = False):
+        if shape not in shapes:
+          raise ValueError("Unknown shape!")
+        knots, idx = basis_knots(d, q, compact)
+        self.shape_fn = shape
+        self.shape = (d.shape[0], knots.shape[0])
+
+        self.d = torch.from_numpy(np.asarray(d, dtype='float64'))
+        self.knots = torch.from_numpy(np.asarray(knots, dtype='float64'))
+        self.mask = torch.ones(self.shape[0], dtype=torch.bool)
+        if idx is not None:
+          self.mask[torch.as_tensor(idx)] = False
+
+        # sorted knots for the forward, sorted distances for the backward
+        self.sorted_knots, self.knot_order = torch.sort(self.knots)
+        self.sorted_d, self.d_order = torch.sort(self.d)
+
+    def matmul(self, W):
+        return ShapeBasisFunction.apply(W, self)
+
+    __matmul__ = matmul
+
+    @staticmethod
+    def _cumsum(x):
+        # prepend a zero row so that C[i] is the sum of the first i rows
+        return torch.cat((torch.zeros_like(x[:1]), x.cumsum(0)))
+
+    def _matmul(self, W):
+        """
+        W : [k, T] -> [m, T]
+        """
+        s = self.sorted_knots.unsqueeze(-1)
+        d = self.d.unsqueeze(-1)
+        W_ = W.detach().double()[self.knot_order]
+        k = s.size(0)
+        C0 = self._cumsum(W_)
+        le = torch.searchsorted(self.sorted_knots, self.d, right=True) # s_i <= d
+        lt = torch.searchsorted(self.sorted_knots, self.d) # s_i < d
+        zero = torch.tensor([0.0], dtype=s.dtype)
+
+        if self.shape_fn == 'monotone_inc':
+            n0 = torch.searchsorted(self.sorted_knots, zero, right=True)
+            F = C0[le] - C0[n0]
+        elif self.shape_fn == 'monotone_dec':
+            F = C0[k] - C0[lt]
+        else:
+            C1 = self._cumsum(s * W_)
+            S0 = C0[k] - C0[lt] # sum over s_i >= d
+            S1 = C1[k] - C1[lt]
+            if self.shape_fn == 'concave_inc':
+                n0 = torch.searchsorted(self.sorted_knots, zero)
+                F = d * S0 - S1 + (C1[k] - C1[n0])
+            else:
+                F = S1 - d * S0
+
+        F[~self.mask] = 0
+        return F.to(W.dtype)
+
+    def _rmatmul(self, G):
+        """
+        g.t() @ G, G : [m, T] -> [k, T]
+        """
+        s = self.knots.unsqueeze(-1)
+        G_ = G.double() * self.mask.unsqueeze(-1)
+        G_ = G_[self.d_order]
+        m = G_.size(0)
+        D0 = self._cumsum(G_)
+
+        if self.shape_fn == 'monotone_inc':
+            lt = torch.searchsorted(self.sorted_d, self.knots) # d < s_i
+            grad = (D0[m] - D0[lt]) - (s <= 0) * D0[m]
+        else:
+            le = torch.searchsorted(self.sorted_d, self.knots, right=True) # d <= s_i
+            if self.shape_fn == 'monotone_dec':
+                grad = D0[le]
+            else:
+                D1 = self._cumsum(self.sorted_d.unsqueeze(-1) * G_)
+                if self.shape_fn == 'concave_inc':
+                    grad = D1[le] - s * D0[le] + s * (s >= 0) * D0[m]
+                else:
+                    grad = s * D0[le] - D1[le]
+
+        return grad.to(G.dtype)
+
+
+class UniqueBasis:
+    """
+    Basis over the unique distance values: (i, j) and (j, i) share a row and
+    duplicated knots share a column, so g is [U, K] with U, K ~ m / 2.
+    inverse maps each flattened pair i * N + j to its row, rows zeroed out in
+    quantile mode point to an extra zero row. F = (g @ W)[inverse]
+    """
+    def __init__(self, d, shape, q = None, compact = False):
+        knots, idx = basis_knots(d, q, compact)
+        rows, inverse = np.unique(d, return_inverse=True)
+        knots = np.unique(knots)
+
+        g = _evaluate_basis(rows, knots, shape)
+        if idx is not None:
+          g = np.concatenate((g, np.zeros_like(g[:1])))
+          inverse[idx] = rows.shape[0]
+
+        self.g = torch.from_numpy(g).float() # [U, K]
+        self.inverse = torch.from_numpy(inverse.reshape(-1)).long() # [m]
+        self.shape = (d.shape[0], knots.shape[0])
+
+    def matmul(self, W):
+        # compressed product, expanded to the N ** 2 pairs
+        return torch.matmul(self.g, W)[self.inverse]
+
+    __matmul__ = matmul
+
+
+class PackedBasisFunction(torch.autograd.Function):
+    """
+    F = g @ W for a PackedBasis g, unpacking one block of rows at a time
+    """
+
+    @staticmethod
+    def forward(ctx, W, op):
+        ctx.op = op
+        return op._matmul(W)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return ctx.op._rmatmul(grad), None
+
+
+class PackedBasis:
+    """
+    Bit-packed basis for the step shapes 'monotone_inc' and 'monotone_dec'.
+    Their entries are 0, 1 or -1 with a sign that is constant per column,
+    so g = bits * sign with one bit per entry (np.packbits) and a [k] sign
+    """
+    def __init__(self, d, shape, q = None, compact = False, max_bytes = 2 ** 26):
+        if shape not in ('monotone_inc', 'monotone_dec'):
+          raise ValueError("Bit-packing needs a step shape!")
+        knots, idx = basis_knots(d, q, compact)
+        m, k = d.shape[0], knots.shape[0]
+        self.shape = (m, k)
+        self.block = max(1, min(m, max_bytes // (8 * max(k, 1))))
+
+        # monotone_inc columns with a non-positive knot are a - 1 <= 0
+        sign = np.ones(k)
+        if shape == 'monotone_inc':
+          sign[knots <= 0.0] = -1
+        self.sign = torch.from_numpy(sign).float()
+
+        self.bits = np.empty((m, (k + 7) // 8), dtype=np.uint8) # [m, k / 8]
+        for start in range(0, m, self.block):
+            stop = min(start + self.block, m)
+            g = _shape_columns(d[start:stop], knots, shape)
+            self.bits[start:stop] = np.packbits(g != 0, axis=1)
+        if idx is not None:
+          self.bits[idx, ] = 0
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.sign.numel() * 4
+
+    def unpack(self, start, stop, dtype=torch.float32):
+        # {0, 1} rows start:stop of the magnitude plane
+        bits = np.unpackbits(self.bits[start:stop], axis=1, count=self.shape[1])
+        return torch.from_numpy(bits).to(dtype)
+
+    def matmul(self, W):
+        return PackedBasisFunction.apply(W, self)
+
+    __matmul__ = matmul
+
+    def _matmul(self, W):
+        """
+        W : [k, T] -> [m, T]
+        """
+        W = W.detach() * self.sign.to(W.dtype).unsqueeze(-1)
+        F = W.new_empty(self.shape[0], W.size(1))
+        for start in range(0, self.shape[0], self.block):
+            stop = min(start + self.block, self.shape[0])
+            torch.matmul(self.unpack(start, stop, W.dtype), W, out=F[start:stop])
+        return F
+
+    def _rmatmul(self, G):
+        """
+        g.t() @ G, G : [m, T] -> [k, T]
+        """
+        grad = G.new_zeros(self.shape[1], G.size(1))
+        for start in range(0, self.shape[0], self.block):
+            stop = min(start + self.block, self.shape[0])
+            grad += self.unpack(start, stop, G.dtype).t() @ G[start:stop]
+        return grad * self.sign.to(G.dtype).unsqueeze(-1)
+
+
+def basis_matmul(g, W):
+    """
+    g @ W for a dense, sparse or matrix-free basis g
+    """
+    if isinstance(g, torch.Tensor):
+        if g.layout != torch.strided:
+            return torch.sparse.mm(g, W)
+        return torch.matmul(g, W)
+    return g.matmul(W)
+
+
+def build_basis(d, shape, q = None, mode = 'dense', sparse = None, compact = False, cache = None):
+    """
+    mode : 'dense' builds g as a (sparse) tensor, 'operator' never materializes it,
+           'unique' builds it over the unique distances,
+           'packed' stores it with one bit per entry (step shapes only)
+    sparse : defaults to quantile thresholds below 200
+    compact : keep only the q quantile columns, g is [N ** 2, q]
+    cache : BasisCache or its directory, dense bases are loaded from / saved to it
+    """
+    compact = compact and q is not None
+    if mode == 'operator':
+        return ShapeBasisOperator(d, shape, q, compact)
+    elif mode == 'unique':
+        return UniqueBasis(d, shape, q, compact)
+    elif mode == 'packed':
+        return PackedBasis(d, shape, q, compact)
+    elif mode != 'dense':
+        raise ValueError("Unknown basis mode!")
+
+    if sparse is None:
+        sparse = q is not None and q < 200 and not compact
+    if cache is not None:
+        if not isinstance(cache, BasisCache):
+            cache = BasisCache(cache)
+        key = cache.key(d, shape, q, compact, sparse)
+        g = cache.get(key)
+        if g is not None:
+            return g
+
+    g = basis_function(d, shape, q, compact = compact)
+    g = torch.from_numpy(g).float() # [N ** 2, N ** 2]
+    if sparse:
+        g = g.to_sparse()
+    if cache is not None:
+        g = cache.put(key, g)
+    return g
 
 
 